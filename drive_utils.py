@@ -6,6 +6,7 @@ class DriveService:
     def __init__(self, *, drive_service, sheets_service):
         self.drive_service = drive_service
         self.sheets_service = sheets_service
+        self._search_cache: dict[tuple, str] = {}
 
     def search_drive(
         self,
@@ -15,43 +16,67 @@ class DriveService:
         file_type: Literal["sheet", "folder", None] = None,
     ) -> str:
         """
-        Returns the file id of the first query
+        Returns the file id of the first query. Found ids are cached, so
+        repeated lookups (including of the same parent folder) don't hit the
+        Drive api again. Use clear_search_cache if files are moved or deleted.
 
         :param name: The name of the requested file.
         :param parent: The name of the parent folder.
         :param file_type:
         """
+        key = (name, parent, file_type)
+        if key in self._search_cache:
+            return self._search_cache[key]
         lst = []
         if name:
             lst.append(f"name = '{name}'")
         if parent:
-            lst.append(f"parents in {self.search_drive( name=parent)}")
+            parent_id = self.search_drive(name=parent, file_type="folder")
+            if not parent_id:
+                return ""
+            lst.append(f"'{parent_id}' in parents")
         if file_type:
             if file_type == "folder":
                 lst.append(f"mimeType = 'application/vnd.google-apps.folder'")
             if file_type == "sheet":
                 lst.append(f"mimeType = 'application/vnd.google-apps.spreadsheet'")
         query = " and ".join(lst)
-        results = (
-            self.drive_service.files().list(q=query, fields="files(id, name)").execute()
-        )
+        results = self.drive_service.files().list(q=query, fields="files(id)").execute()
         items = results.get("files", [])
         if not items:
             return ""
+        self._search_cache[key] = items[0]["id"]
         return items[0]["id"]
 
-    def add_row(self, *, row_data: dict, sheet_id: str, tab_name: str):
+    def clear_search_cache(self):
+        """
+        Forgets the file ids found by search_drive.
+        """
+        self._search_cache.clear()
+
+    def add_row(self, *, row_data: list, sheet_id: str, tab_name: str):
         """
-        Adds a row to the given spreadsheet.
+        Adds a row to the given spreadsheet. Use add_rows to add several rows
+        with a single request.
 
         :param row_data: The row data to append to the sheet
         :param sheet_id: The id of the spreadsheet to add to.
         :param tab_name: The name of the specific tab to add to.
         """
+        self.add_rows(rows=[row_data], sheet_id=sheet_id, tab_name=tab_name)
+
+    def add_rows(self, *, rows: List[list], sheet_id: str, tab_name: str):
+        """
+        Adds multiple rows to the given spreadsheet in a single request.
+
+        :param rows: The rows to append to the sheet, in order.
+        :param sheet_id: The id of the spreadsheet to add to.
+        :param tab_name: The name of the specific tab to add to.
+        """
         value_input_option = "USER_ENTERED"
         insert_data_option = "INSERT_ROWS"
         value_range_body = {
-            "values": [row_data],
+            "values": rows,
             "majorDimension": "ROWS",
         }
         (
@@ -93,12 +118,41 @@ class DriveService:
             )
         ).execute()
 
+    def update_cells(self, *, cells: dict[str, Any], sheet_id: str, tab_name: str):
+        """
+        Updates several cells of the given spreadsheet in a single request.
+
+        :param cells: The new cell values, keyed by cell location. Ex: {"E2": 5}
+        :param sheet_id: The id of the spreadsheet to add to.
+        :param tab_name: The name of the specific tab to add to.
+        """
+        if not cells:
+            return
+        value_input_option = "USER_ENTERED"
+        batch_update_body = {
+            "valueInputOption": value_input_option,
+            "data": [
+                {
+                    "range": f"{tab_name}!{cell_loc}",
+                    "values": [[cell_value]],
+                    "majorDimension": "ROWS",
+                }
+                for cell_loc, cell_value in cells.items()
+            ],
+        }
+        (
+            self.sheets_service.spreadsheets()
+            .values()
+            .batchUpdate(spreadsheetId=sheet_id, body=batch_update_body)
+        ).execute()
+
     def read_sheet(
         self,
         sheet_id: str,
         *,
         range: str,
         axis: Literal["rows", "columns"] = "rows",
+        index_col: Optional[str] = None,
     ) -> pd.DataFrame:
         """
         Returns a 2D list of the sheet section as defined by the range.
@@ -106,6 +160,7 @@ class DriveService:
         :param sheet_id: The id of the sheet to read.
         :param range: The range of the sheet to read. e.g. "Sheet1!A:B".
         :param axis: The organization of the data by rows or columns.
+        :param index_col: The header of the column to use as the index.
         """
         result = (
             self.sheets_service.spreadsheets()
@@ -124,4 +179,6 @@ class DriveService:
         df = pd.DataFrame(values[1:], columns=values[0])
         df = df.map(lambda x: x.strip() if isinstance(x, str) else x)
         df = df.replace(["", None], "", regex=True)
+        if index_col:
+            df = df.set_index(index_col)
         return df
@@ -2,20 +2,44 @@ from typing import Iterable, Any, List, Optional, Literal
 
 import io
 import re
+import threading
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import lru_cache
+from base64 import urlsafe_b64encode
 from email.mime.text import MIMEText
 
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import build_http
 
-@dataclass(init=False, repr=False)
+try:
+    # SIMD accelerated, decodes message bodies several times faster
+    from pybase64 import urlsafe_b64decode
+except ImportError:
+    from base64 import urlsafe_b64decode
+
+_ANGLE_RE = re.compile(r"<([^>]*)>")
+_QUOTE_LINE_RE = re.compile(r"\n>[^\n]*")
+
+# the headers _parse_message reads
+_METADATA_HEADERS = ["From", "To", "Cc", "Subject", "Date"]
+_EMAIL_HEADERS = frozenset(header.lower() for header in _METADATA_HEADERS)
+
+# the parts of a message resource that _parse_message reads
+_MESSAGE_FIELDS = "payload(headers(name,value),parts(mimeType,body/data,parts))"
+
+
+@dataclass(init=False, repr=False, slots=True)
 class Email:
+    # _parse_message assigns every field, no instance needs a __dict__
     To: str
-    Cc: Optional[str] = None
     From: str
     Subject: str
     Contents: str
     Date: str
+    Cc: Optional[str] = None
 
     def __str__(self, hide_date: bool = False) -> str:
         sb = io.StringIO()
@@ -28,23 +52,99 @@ class Email:
         return sb.getvalue()
 
 
+@lru_cache(maxsize=4096)
 def extract_substring(text: str) -> str:
     """Returns the substrings inside of <> or the string itself if <> does not exist"""
-    lst: list[str] = text.split(", ")
-    for i in range(len(lst)):
-        match = re.search(r"<(.*?)>", lst[i])
-        if match:
-            lst[i] = match.group(1)
-    text = ", ".join(lst)
-    return text
+    # the same To/From/Cc strings come up again in main for every message of
+    # a thread, so the result is memoized
+    return ", ".join(
+        match.group(1) if (match := _ANGLE_RE.search(fragment)) else fragment
+        for fragment in text.split(", ")
+    )
+
+
+def _extract_headers(headers: List[dict[str, str]]) -> dict[str, str]:
+    """
+    Returns the headers read into an Email, keyed by their lowercased name.
+    If a header appears more than once, the last value is kept.
+
+    :param headers: The headers of a Gmail message payload.
+    """
+    values = {}
+    for header in headers:
+        name = header["name"].lower()
+        if name in _EMAIL_HEADERS:
+            values[name] = header["value"]
+    return values
+
+
+def _headers_only(msg: dict[str, Any]) -> dict[str, Any]:
+    """
+    Returns the given message resource without its body, as if it had been
+    fetched with format="metadata".
+    """
+    return {"payload": {"headers": msg.get("payload", {}).get("headers", [])}}
+
+
+def _get_message(
+    messages_resource, message_id: str, format: Literal["full", "metadata"]
+):
+    """
+    Returns the messages.get request for the given message, asking only for
+    the parts of the resource _parse_message reads.
+
+    :param messages_resource: The resource from service.users().messages(),
+        built once by callers that request many messages.
+    :param message_id: The id of the message.
+    :param format: "full" fetches the headers and body, "metadata" only the
+        headers.
+    """
+    if format == "metadata":
+        return messages_resource.get(
+            userId="me",
+            id=message_id,
+            format="metadata",
+            metadataHeaders=_METADATA_HEADERS,
+            fields="payload/headers(name,value)",
+        )
+    return messages_resource.get(
+        userId="me", id=message_id, format="full", fields=_MESSAGE_FIELDS
+    )
 
 
 class EmailService:
-    def __init__(self, service):
+    def __init__(self, service, credentials=None, message_cache_size: int = 1024):
         self.service = service
+        self.credentials = credentials
+        self.message_cache_size = message_cache_size
+        self._local = threading.local()
+        self._message_cache: dict[str, dict[str, Any]] = {}
+        self._message_cache_lock = threading.Lock()
+
+    def _cache_message(self, message_id: str, msg: dict[str, Any]):
+        """
+        Stores a fetched message resource. Sent messages don't change, so
+        entries are only evicted (oldest first) once the cache is full.
+        """
+        with self._message_cache_lock:
+            if len(self._message_cache) >= self.message_cache_size:
+                self._message_cache.pop(next(iter(self._message_cache)))
+            self._message_cache[message_id] = msg
+
+    def _http(self) -> Optional[AuthorizedHttp]:
+        """
+        Returns an authorized http object for the current thread, since
+        httplib2 connections can't be shared between threads. Returns None
+        (the service's own http object) if no credentials were given.
+        """
+        if self.credentials is None:
+            return None
+        if not hasattr(self._local, "http"):
+            self._local.http = AuthorizedHttp(self.credentials, http=build_http())
+        return self._local.http
 
     def search_threads(
-        self, query: str, newest_first: bool = False
+        self, query: str, newest_first: bool = False, *, batch_size: int = 50
     ) -> Iterable[dict[str, Any]]:
         """
         Returns an iterable of the message objects based on the given query.
@@ -52,34 +152,68 @@ class EmailService:
 
         :param service: The Resource item from googleapiclient.discovery.build()
         :param query: The query term. Ex: label:Networking
+        :param batch_size: The number of threads fetched per batch request.
+            Threads are only fetched as the iterable is consumed, so callers
+            that only read the first few messages should pass a small value.
         """
-        results = self.service.users().threads().list(userId="me", q=query).execute()
-        threads = results.get("threads", [])
+        # stream one batch of threads at a time instead of fetching every
+        # thread of a page (or every page) before yielding any messages
+        threads_resource = self.service.users().threads()
+        request = threads_resource.list(
+            userId="me",
+            q=query,
+            maxResults=500,
+            fields="threads/id,nextPageToken",
+        )
+        while request is not None:
+            results = request.execute()
+            thread_ids = [result["id"] for result in results.get("threads", [])]
+            for thread in self._get_threads(thread_ids, batch_size=batch_size):
+                if newest_first:
+                    thread = thread[::-1]
+                yield from thread
+            request = threads_resource.list_next(request, results)
 
-        while "nextPageToken" in results:
-            page_token = results["nextPageToken"]
+    def _get_threads(
+        self, thread_ids: List[str], *, batch_size: int = 50
+    ) -> Iterable[List[dict[str, Any]]]:
+        """
+        Returns an iterable of the message objects of each of the given
+        threads, in the same order. Fetches up to batch_size threads per batch
+        request, and only sends the next batch once the previous threads have
+        been consumed. Threads whose fetch fails inside a batch are fetched on
+        their own.
 
-            results = (
-                self.service.users()
-                .threads()
-                .list(userId="me", q=query, pageToken=page_token)
-                .execute()
-            )
+        :param thread_ids: The ids of the threads to fetch.
+        :param batch_size: The number of threads fetched per batch request.
+        """
+        # only the message ids are needed, read_message fetches the full
+        # payload separately
+        threads_resource = self.service.users().threads()
+        responses: dict[str, List[dict[str, Any]]] = {}
 
-            threads.extend(results.get("threads", []))
+        def store_response(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response["messages"]
 
-        for result in threads:
-            thread: List[dict[str, Any]] = (
-                self.service.users()
-                .threads()
-                .get(userId="me", id=result["id"])
-                .execute()["messages"]
-            )
-            if newest_first:
-                x = [msg for msg in thread]
-                thread = x[::-1]
-            for msg in thread:
-                yield msg
+        for start in range(0, len(thread_ids), batch_size):
+            batch = self.service.new_batch_http_request(callback=store_response)
+            for i in range(start, min(start + batch_size, len(thread_ids))):
+                batch.add(
+                    threads_resource.get(
+                        userId="me", id=thread_ids[i], fields="messages/id"
+                    ),
+                    request_id=str(i),
+                )
+            batch.execute()
+            for i in range(start, min(start + batch_size, len(thread_ids))):
+                messages = responses.pop(str(i), None)
+                if messages is None:
+                    # e.g. rate limited within the batch, retried with backoff
+                    messages = threads_resource.get(
+                        userId="me", id=thread_ids[i], fields="messages/id"
+                    ).execute(http=self._http(), num_retries=3)["messages"]
+                yield messages
 
     def search_messages(self, query: str) -> List[dict[str, str]]:
         """
@@ -89,111 +223,199 @@ class EmailService:
         :param service: The Resource item from googleapiclient.discovery.build()
         :param query: The query term. Ex: from:email@address.com
         """
-        result = self.service.users().messages().list(userId="me", q=query).execute()
-        messages = []
-        if "messages" in result:
-            messages.extend(result["messages"])
-        while "nextPageToken" in result:
-            page_token = result["nextPageToken"]
-            result = (
-                self.service.users()
-                .messages()
-                .list(userId="me", q=query, pageToken=page_token)
-                .execute()
-            )
-            if "messages" in result:
-                messages.extend(result["messages"])
-        return messages
-
-    def parse_parts(
-        self, parts, folder_name: str, message: dict[str, str]
-    ) -> Iterable[str]:
-        """
-        Utility function that parses the content of an email partition
-        """
-
-        if parts:
-            for part in parts:
-                mimeType = part.get("mimeType")
-                body = part.get("body")
-                data = body.get("data")
-                if part.get("parts"):
-                    # recursively call this function when we see that a part
-                    # has parts inside
-                    yield from self.parse_parts(part.get("parts"), folder_name, message)
-                if mimeType == "text/plain" and data:
-                    # if the email part is text plain
-                    text = urlsafe_b64decode(data).decode()
-                    # print(text)
-                    yield text
+        return list(self.iter_messages(query))
+
+    def iter_messages(self, query: str) -> Iterable[dict[str, str]]:
+        """
+        Returns an iterable of the message objects based on the given query,
+        like search_messages, but yields each page as it is fetched instead of
+        collecting every page first.
+
+        :param query: The query term. Ex: from:email@address.com
+        """
+        messages_resource = self.service.users().messages()
+        request = messages_resource.list(
+            userId="me",
+            q=query,
+            maxResults=500,
+            fields="messages/id,nextPageToken",
+        )
+        while request is not None:
+            result = request.execute()
+            yield from result.get("messages", [])
+            request = messages_resource.list_next(request, result)
+
+    def parse_parts(self, parts) -> Iterable[bytes]:
+        """
+        Utility function that parses the content of an email partition.
+        Yields the decoded bytes of each text/plain part.
+        """
+
+        # walk the MIME tree depth first with an explicit stack, so nested
+        # parts are still read in document order
+        stack = deque(parts or ())
+        while stack:
+            part = stack.popleft()
+            subparts = part.get("parts")
+            if subparts:
+                stack.extendleft(reversed(subparts))
+            if part.get("mimeType") != "text/plain":
+                continue
+            # the partial response leaves out body entirely when it has no data
+            data = (part.get("body") or {}).get("data")
+            if data:
+                yield urlsafe_b64decode(data)
 
     def read_message(
-        self, message: dict[str, str], *, echo=False, show_trimmed_content=False
+        self,
+        message: dict[str, str],
+        *,
+        echo=False,
+        show_trimmed_content=False,
+        format: Literal["full", "metadata"] = "full",
     ) -> Email:
         """
         This function takes Gmail API `service` and the given `message_id` and does the following:
             - Parses the contents of the message to Email and returns
-            - Downloads any file that is attached to the email and saves it in the folder created
 
         :param service: the api passed in
         :param message: the message id
+        :param format: "metadata" only fetches the headers, leaving Contents
+            empty. Use it when the body isn't needed.
 
         returns: Email containing all information about the message
         """
-        msg = (
-            self.service.users()
-            .messages()
-            .get(userId="me", id=message["id"], format="full")
-            .execute()
+        msg = self._message_cache.get(message["id"])
+        if msg is None:
+            msg = _get_message(
+                self.service.users().messages(), message["id"], format
+            ).execute(http=self._http(), num_retries=3)
+            if format == "full":
+                self._cache_message(message["id"], msg)
+        if format == "metadata":
+            msg = _headers_only(msg)
+        return self._parse_message(
+            msg, echo=echo, show_trimmed_content=show_trimmed_content
         )
 
+    def _parse_message(
+        self, msg: dict[str, Any], *, echo=False, show_trimmed_content=False
+    ) -> Email:
+        """
+        Parses a full Gmail message resource into an Email.
+
+        :param msg: The message resource, fetched with format="full".
+        """
         mail = Email()
 
         # parts can be the message body, or attachments
         payload = msg["payload"]
-        headers = payload.get("headers")
+        headers = _extract_headers(payload.get("headers") or [])
         parts = payload.get("parts")
-        folder_name = "email"
-        if headers:
-            # this section prints email basic info & creates a folder for the email
-            for header in headers:
-                name = header.get("name")
-                value = header.get("value")
-                if name.lower() == "from":
-                    # we print the From address
-                    mail.From = value
-                if name.lower() == "to":
-                    # we print the To address
-                    mail.To = value
-                if name.lower() == "subject":
-                    # make a directory with the name of the subject
-                    mail.Subject = value
-                if name.lower() == "date":
-                    # we print the date when the message was sent
-                    mail.Date = value
-                if name.lower() == "cc":
-                    mail.Cc = value
-            if "To" not in mail.__dict__.keys():
-                mail.To = ""
-            if mail.Cc and (
-                extract_substring(mail.Cc) in extract_substring(mail.To)
-                or extract_substring(mail.Cc) in extract_substring(mail.From)
-            ):
+        mail.From = headers.get("from", "")
+        mail.To = headers.get("to", "")
+        mail.Subject = headers.get("subject", "")
+        mail.Date = headers.get("date", "")
+        mail.Cc = headers.get("cc")
+        if mail.Cc:
+            cc = extract_substring(mail.Cc)
+            if cc in extract_substring(mail.To) or cc in extract_substring(mail.From):
                 mail.Cc = None
-        contents = self.parse_parts(parts, folder_name, message)
-        mail.Contents = "\n\n".join([c for c in contents])
+        # decode the joined parts once instead of each part separately
+        mail.Contents = b"\n\n".join(self.parse_parts(parts)).decode(errors="replace")
         if not show_trimmed_content:
-            lines = mail.Contents.split("\n")
-            filtered_lines = [line for line in lines if not line.startswith(">")]
-            if len(filtered_lines) < len(lines):
-                filtered_lines = filtered_lines[:-3]
-            mail.Contents = "\n".join(filtered_lines).rstrip()
+            # drop quoted lines, along with the newline before each of them
+            trimmed, quoted = _QUOTE_LINE_RE.subn("", "\n" + mail.Contents)
+            trimmed = trimmed[1:]
+            if quoted:
+                # and the "On <date>, <sender> wrote:" lines above the quote
+                remaining = trimmed.rsplit("\n", 3)
+                trimmed = remaining[0] if len(remaining) == 4 else ""
+            mail.Contents = trimmed.rstrip()
         if echo:
             print("=" * 20)
             print(mail)
             print("=" * 20)
         return mail
 
+    def read_messages(
+        self, messages: Iterable[dict[str, str]], *, max_workers: int = 8, **kwargs
+    ) -> List[Email]:
+        """
+        Reads the given messages concurrently and returns them in the same
+        order. Reads them one at a time if the service has no credentials to
+        give each thread its own connection.
+
+        :param messages: The message ids, as returned by search_threads.
+        :param max_workers: The maximum number of messages fetched at once.
+        :param kwargs: Keyword arguments passed on to read_message.
+        """
+        if self.credentials is None:
+            return [self.read_message(message, **kwargs) for message in messages]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(
+                executor.map(
+                    lambda message: self.read_message(message, **kwargs), messages
+                )
+            )
+
+    def read_messages_batch(
+        self,
+        messages: Iterable[dict[str, str]],
+        *,
+        batch_size: int = 50,
+        format: Literal["full", "metadata"] = "full",
+        **kwargs,
+    ) -> List[Email]:
+        """
+        Reads the given messages with batch requests, sending up to
+        batch_size message fetches per HTTP request. Returns them in the same
+        order. Gmail recommends batches of at most 50 to avoid rate limits.
+        Messages whose fetch fails inside a batch are read on their own.
+
+        :param messages: The message ids, as returned by search_threads.
+        :param batch_size: The number of messages fetched per batch request.
+        :param format: "metadata" only fetches the headers, as in read_message.
+        :param kwargs: Other keyword arguments of read_message (echo,
+            show_trimmed_content).
+        """
+        messages = list(messages)
+        responses: dict[str, dict[str, Any]] = {}
+        uncached = []
+        for i, message in enumerate(messages):
+            msg = self._message_cache.get(message["id"])
+            if msg is None:
+                uncached.append(i)
+            else:
+                responses[str(i)] = msg
+
+        def store_response(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+                if format == "full":
+                    self._cache_message(messages[int(request_id)]["id"], response)
+
+        messages_resource = self.service.users().messages()
+        for start in range(0, len(uncached), batch_size):
+            batch = self.service.new_batch_http_request(callback=store_response)
+            for i in uncached[start : start + batch_size]:
+                batch.add(
+                    _get_message(messages_resource, messages[i]["id"], format),
+                    request_id=str(i),
+                )
+            batch.execute()
+        mails = []
+        for i, message in enumerate(messages):
+            response = responses.get(str(i))
+            if response is None:
+                # e.g. rate limited within the batch, retried with backoff
+                mails.append(self.read_message(message, format=format, **kwargs))
+                continue
+            if format == "metadata":
+                response = _headers_only(response)
+            mails.append(self._parse_message(response, **kwargs))
+        return mails
+
     def send_email(
         self,
         to: str,
@@ -1,46 +1,100 @@
+import asyncio
 import os
+from functools import lru_cache
+from typing import List
 
 import openai
-from apify_client import ApifyClient
 
 from dotenv import load_dotenv
 
 load_dotenv()
-apify_client = ApifyClient(os.getenv("APIFY_API_KEY"))
 
 
-def summarize_email(user: str, message: str) -> str:
+@lru_cache(maxsize=None)
+def get_apify_client():
     """
-    Returns a 1-2 sentence summary of the given message.
+    Returns the Apify client. It is only imported and constructed on first
+    use since only the reminder emails scrape webpages.
+    """
+    from apify_client import ApifyClient
+
+    return ApifyClient(os.getenv("APIFY_API_KEY"))
+
+
+@lru_cache(maxsize=None)
+def get_openai_client():
+    """
+    Returns the OpenAI client. It is constructed on first use, after main has
+    set openai.api_key.
+    """
+    return openai.OpenAI(api_key=openai.api_key)
+
+
+def _summary_messages(user: str, message: str) -> list:
+    """
+    Returns the chat messages used to summarize an email.
 
     :param user: The user, whom which the system will refer to as "you".
     :param message: The email contents.
     """
-
-    summary = (
-        openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"""I am {user}. Refer to all instances of {user} as "you". Summarize the given emails in 2 short sentences or fewer.
+    return [
+        {
+            "role": "system",
+            "content": f"""I am {user}. Refer to all instances of {user} as "you". Summarize the given emails in 2 short sentences or fewer.
                             
                             Example summary 1: You sent a message to person B asking them for an internship. You were inspired by their talk at the YC event and gave them your contact information.
                             Example summary 2: John Doe responded to you saying that they were impressed with your resume and would like to set up a meeting with you.
                             """,
-                },
-                {
-                    "role": "user",
-                    "content": f"{message}",
-                },
-            ],
-            temperature=0.05,
-        )
-        .choices[0]  # type: ignore
-        .message.content
-    )
+        },
+        {
+            "role": "user",
+            "content": f"{message}",
+        },
+    ]
 
-    return summary
+
+async def _summarize_emails_async(
+    user: str, messages: List[str], max_concurrency: int
+) -> List[str]:
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async with openai.AsyncOpenAI(api_key=openai.api_key) as client:
+
+        async def summarize(message: str) -> str:
+            async with semaphore:
+                try:
+                    response = await client.chat.completions.create(
+                        model="gpt-3.5-turbo",
+                        messages=_summary_messages(user, message),  # type: ignore
+                        temperature=0.05,
+                    )
+                except openai.OpenAIError:
+                    # e.g. rate limited or timed out, the other emails are
+                    # still summarized and written
+                    return "Summarization failed"
+            return response.choices[0].message.content  # type: ignore
+
+        return await asyncio.gather(*(summarize(message) for message in messages))
+
+
+def summarize_emails(
+    user: str, messages: List[str], max_concurrency: int = 8
+) -> List[str]:
+    """
+    Returns a 1-2 sentence summary of each of the given messages, in order.
+    Up to max_concurrency summaries are requested at the same time.
+
+    :param user: The user, whom which the system will refer to as "you".
+    :param messages: The contents of each email.
+    :param max_concurrency: The maximum number of requests in flight.
+    """
+    if not messages:
+        return []
+    try:
+        return asyncio.run(_summarize_emails_async(user, messages, max_concurrency))
+    except openai.OpenAIError:
+        # e.g. OPENAI_API_KEY isn't set, the emails are still written
+        return ["Summarization failed"] * len(messages)
 
 
 def summarize_webpage(url: str):
@@ -63,6 +117,8 @@ def summarize_webpage(url: str):
         "maxPagesPerCrawl": 10,
     }
 
+    apify_client = get_apify_client()
+
     # Run the actor and wait for it to finish
     run = apify_client.actor("drobnikj/gpt-scraper").call(run_input=run_input)
 
@@ -73,7 +129,8 @@ def summarize_webpage(url: str):
 
 def summarize_company_innovations(text: str):
     summary = (
-        openai.ChatCompletion.create(
+        get_openai_client()
+        .chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {
@@ -101,7 +158,8 @@ etc.""",
 
 def generate_response_email_from_messages(user: str, messages: str):
     summary = (
-        openai.ChatCompletion.create(
+        get_openai_client()
+        .chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {
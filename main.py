@@ -8,13 +8,22 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
 from dotenv import load_dotenv
 import openai
 import pandas as pd
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import time
-import googlesearch
-import csv
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+
+try:
+    # parses the full message resources several times faster than json
+    import orjson
+except ImportError:
+    orjson = None
 
 from utils import *
 from email_utils import *
@@ -34,7 +43,10 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 
 
 def connect(
-    token_json_path: str = "token.json", cred_json_path: str = "credentials.json"
+    token_json_path: str = "token.json",
+    cred_json_path: str = "credentials.json",
+    *,
+    interactive: bool = True,
 ):
     """
     Returns credential to connect to API. This cred object can be used to build
@@ -43,6 +55,8 @@ def connect(
     :param token_json_path: The path to the token json. If already filled,
         doesn't change
     :param cred_json_path: The path to the credential file. This is exported from google.
+    :param interactive: If False, returns None instead of opening the browser
+        authorization flow when the saved token can't be used or refreshed.
     """
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
@@ -54,6 +68,8 @@ def connect(
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
+        elif not interactive:
+            return None
         else:
             flow = InstalledAppFlow.from_client_secrets_file(cred_json_path, SCOPES)
             creds = flow.run_local_server(port=0)
@@ -63,6 +79,42 @@ def connect(
     return creds
 
 
+class _OrjsonModel(JsonModel):
+    """JsonModel that parses response bodies with orjson."""
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
+
+@lru_cache(maxsize=8)
+def build_service(api: str, version: str, credentials):
+    """
+    Returns the API resource for the given api and version. Uses the
+    discovery documents bundled with googleapiclient, so no discovery
+    document is downloaded or looked up in a discovery cache. Resources are
+    memoized per credentials object, so the discovery document is only
+    parsed once per api.
+
+    :param api: The name of the api. e.g. "gmail".
+    :param version: The version of the api. e.g. "v1".
+    :param credentials: The credentials returned by connect().
+    """
+    return build(
+        api,
+        version,
+        credentials=credentials,
+        static_discovery=True,
+        cache_discovery=False,
+        model=_OrjsonModel() if orjson else None,
+    )
+
+
 def search_emails_and_update_sheet(
     gmail_service: EmailService,
     drive_service: DriveService,
@@ -76,52 +128,52 @@ def search_emails_and_update_sheet(
     """
     results = gmail_service.search_threads(query=query)
 
+    # read the Emails tab in the background while the messages are fetched
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        email_df_future = executor.submit(
+            drive_service.read_sheet, sheet_id, range="Emails!A:M"
+        )
+        messages = gmail_service.read_messages_batch(results)
+        email_df = email_df_future.result()
+    seen_contents = set(email_df["content"].to_list())
+    pending_rows: list = []
+    pending_messages: list = []
+    contact_info = contact_df["contact info"]
+    # the same addresses (including the user's own) appear in most messages,
+    # so each address is only matched against the contacts once
+    contact_ids_by_address: dict = {}
+    # the newest last contacted on date of each contact, written in one request
+    last_contacted_cells: dict = {}
+
     # for each email to/from a contact, read it (output plain/text to sheet)
-    for msg in results:
-        # read message
-        message = gmail_service.read_message(msg)
+    for message in messages:
         message.To = extract_substring(message.To)
         message.From = extract_substring(message.From)
         if message.Cc:
             message.Cc = extract_substring(message.Cc)
 
         # collect contact ids
-        tos = message.To.split(", ")
-        ids: list = []
-        for To in tos:
-            ids.extend(
-                contact_df.index[contact_df["contact info"].str.contains(To)].to_list()
-            )
-        ids.extend(
-            contact_df.index[
-                contact_df["contact info"].str.contains(message.From)
-            ].to_list()
-        )
+        addresses = message.To.split(", ") + [message.From]
         if message.Cc:
-            ccs = message.Cc.split(", ")
-            for cc in ccs:
-                ids.extend(
-                    contact_df.index[
-                        contact_df["contact info"].str.contains(cc)
-                    ].to_list()
-                )
+            addresses.extend(message.Cc.split(", "))
+        ids: list = []
+        for address in addresses:
+            if not address:
+                continue
+            if address not in contact_ids_by_address:
+                contact_ids_by_address[address] = contact_df.index[
+                    contact_info.str.contains(address, regex=False)
+                ].to_list()
+            ids.extend(contact_ids_by_address[address])
 
-        # write to Emails tab if the email isn't already in it
+        # queue a row for the Emails tab if the email isn't already in it
         if len(ids) > 0:
-            email_df = drive_service.read_sheet(sheet_id, range="Emails!A:M")
-
-            if message.__str__(hide_date=True) not in email_df["content"].to_list():
-                parsed_date = datetime.strptime(
-                    message.Date, "%a, %d %b %Y %H:%M:%S %z"
-                )
+            content = message.__str__(hide_date=True)
+            if content not in seen_contents:
+                parsed_date = parsedate_to_datetime(message.Date)
                 formatted_date = parsed_date.strftime("%m/%d/%Y %I:%M %p")
 
-                try:
-                    summary = summarize_email(NAME, message)  # type: ignore
-                except openai.BadRequestError:
-                    summary = "Summarization failed"
-
-                row_data = {col: "" for col in email_df.columns}
+                row_data = dict.fromkeys(email_df.columns, "")
                 row_data.update(
                     {
                         "ID": ", ".join(ids),
@@ -129,72 +181,98 @@ def search_emails_and_update_sheet(
                         "contact name(s)": ", ".join(
                             contact_df.loc[ids, "name"].to_list()
                         ),
-                        "summary": summary,
-                        "content": message.__str__(hide_date=True),
+                        "content": content,
                     }
                 )
-                email_df = email_df.append(row_data, ignore_index=True)
-                time.sleep(1)
-                drive_service.add_row(
-                    sheet_id=sheet_id,
-                    row_data=email_df.iloc[-1].to_list(),
-                    tab_name="Emails",
-                )
+                pending_rows.append(row_data)
+                pending_messages.append(message.__str__())
+                seen_contents.add(content)
 
                 # update last contacted on date in Contacts tab
                 for id in ids:
                     d = None
-                    if (
-                        contact_df.at[id, "last contacted on"] != ""
-                        and contact_df.at[id, "last contacted on"] is not None
-                    ):
+                    last_contacted = contact_df.at[id, "last contacted on"]
+                    if last_contacted != "" and last_contacted is not None:
                         try:
-                            d = datetime.strptime(
-                                contact_df.at[id, "last contacted on"], "%m/%d/%y"
-                            ).date()
+                            d = datetime.strptime(last_contacted, "%m/%d/%y").date()
                         except ValueError:
-                            d = datetime.strptime(
-                                contact_df.at[id, "last contacted on"], "%m/%d/%Y"
-                            ).date()
+                            d = datetime.strptime(last_contacted, "%m/%d/%Y").date()
                     if d is None or d < parsed_date.date():
-                        drive_service.update_cell(
-                            cell_value=parsed_date.strftime("%m/%d/%y"),
-                            cell_loc=f"E{int(id)+1}",
-                            sheet_id=sheet_id,
-                            tab_name="Contacts",
+                        last_contacted_cells[f"E{int(id)+1}"] = parsed_date.strftime(
+                            "%m/%d/%y"
                         )
-                        contact_df.loc[id, "last contacted on"] = parsed_date.strftime(
+                        contact_df.at[id, "last contacted on"] = parsed_date.strftime(
                             "%m/%d/%y"
                         )
 
+    # summarize the new emails concurrently and write them with one append
+    # request
+    if pending_rows:
+        summaries = summarize_emails(NAME, pending_messages)
+        for row_data, summary in zip(pending_rows, summaries):
+            row_data["summary"] = summary
+        drive_service.add_rows(
+            sheet_id=sheet_id,
+            rows=[
+                [row_data[col] for col in email_df.columns] for row_data in pending_rows
+            ],
+            tab_name="Emails",
+        )
 
-def main():
-    gmail_creds = connect(
-        token_json_path="gmail_token.json", cred_json_path=GMAIL_CREDENTIALS_PATH
-    )
-    drive_creds = connect(
-        token_json_path="drive_token.json", cred_json_path=DRIVE_CREDENTIALS_PATH
+    # only move the last contacted on dates forward once the emails that
+    # justify them are in the Emails tab
+    drive_service.update_cells(
+        cells=last_contacted_cells, sheet_id=sheet_id, tab_name="Contacts"
     )
 
+
+def main():
+    # refresh both saved tokens concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        gmail_future = executor.submit(
+            connect,
+            token_json_path="gmail_token.json",
+            cred_json_path=GMAIL_CREDENTIALS_PATH,
+            interactive=False,
+        )
+        drive_future = executor.submit(
+            connect,
+            token_json_path="drive_token.json",
+            cred_json_path=DRIVE_CREDENTIALS_PATH,
+            interactive=False,
+        )
+        gmail_creds = gmail_future.result()
+        drive_creds = drive_future.result()
+    # any browser authorization runs serially, gmail first, then drive
+    if gmail_creds is None:
+        gmail_creds = connect(
+            token_json_path="gmail_token.json", cred_json_path=GMAIL_CREDENTIALS_PATH
+        )
+    if drive_creds is None:
+        drive_creds = connect(
+            token_json_path="drive_token.json", cred_json_path=DRIVE_CREDENTIALS_PATH
+        )
+
     try:
-        gmail_service = EmailService(build("gmail", "v1", credentials=gmail_creds))
+        gmail_service = EmailService(
+            build_service("gmail", "v1", gmail_creds), credentials=gmail_creds
+        )
         drive_service = DriveService(
-            drive_service=build("drive", "v3", credentials=drive_creds),
-            sheets_service=build("sheets", "v4", credentials=drive_creds),
+            drive_service=build_service("drive", "v3", drive_creds),
+            sheets_service=build_service("sheets", "v4", drive_creds),
         )
 
         sheet_id = drive_service.search_drive(name=SHEET_NAME, file_type="sheet")
 
-        contact_df = drive_service.read_sheet(sheet_id, range="Contacts!A:M")
-        contact_df = contact_df.set_index("ID")
+        contact_df = drive_service.read_sheet(
+            sheet_id, range="Contacts!A:M", index_col="ID"
+        )
 
         new_contacts = None
         if os.path.exists("contacts.csv"):
-            og_contact_df = pd.read_csv("contacts.csv")
-            og_contact_df = og_contact_df.set_index("ID")  # type: ignore
-            new_contacts = contact_df.loc[
-                [row for row in contact_df.index if row not in og_contact_df.index]
-            ]
+            # read ids as strings so they compare equal to the sheet's ids
+            og_contact_df = pd.read_csv("contacts.csv", index_col="ID", dtype=str)
+            new_contacts = contact_df.loc[~contact_df.index.isin(og_contact_df.index)]
 
         with open("log.txt", "r+") as file:
             initialized = file.read() != ""
@@ -205,6 +283,8 @@ def main():
                     continue
                 contact_address = row["contact info"]
                 address = contact_address.split("\n")[0]
+                # contact_df is updated in place, so it doesn't need to be
+                # re-read from the sheet after each search
                 search_emails_and_update_sheet(
                     gmail_service=gmail_service,
                     drive_service=drive_service,
@@ -212,9 +292,6 @@ def main():
                     contact_df=contact_df,
                     query=f"to:{address} OR from:{address}",
                 )
-                contact_df = drive_service.read_sheet(sheet_id, range="Contacts!A:M")
-
-                contact_df = contact_df.set_index("ID")
                 time.sleep(5)
         elif new_contacts is not None:
             for _, row in new_contacts.iterrows():
@@ -228,9 +305,6 @@ def main():
                     contact_df=contact_df,
                     query=f"to:{address} OR from:{address}",
                 )
-                contact_df = drive_service.read_sheet(sheet_id, range="Contacts!A:M")
-
-                contact_df = contact_df.set_index("ID")
                 time.sleep(5)
         with open("log.txt", "r+") as file:
             log = file.read()
@@ -255,8 +329,9 @@ def main():
         # _____________________________________________________________________
         # Reminders. Sends one reminder email if the contact has not been reached
         # out to after a period of time specified by the sheet
-        contact_df = drive_service.read_sheet(sheet_id, range="Contacts!A:M")
-        contact_df = contact_df.set_index("ID")
+        contact_df = drive_service.read_sheet(
+            sheet_id, range="Contacts!A:M", index_col="ID"
+        )
         for _, row in contact_df.iterrows():
             if row["reminder"] == "" or row["reminder"] is None:
                 continue
@@ -277,6 +352,9 @@ def main():
                     )
                 ]
                 if len(msg) == 0:
+                    # only needed when a reminder is sent
+                    import googlesearch
+
                     string = ""
                     url = googlesearch.search(
                         f"techcrunch new products at {row['company']}",
@@ -299,14 +377,13 @@ def main():
                     threads = gmail_service.search_threads(
                         f"to: {row['contact info']} OR from: {row['contact info']}",
                         newest_first=True,
+                        # only the first 3 messages are read
+                        batch_size=3,
                     )
-                    msgs = []
-                    num_msgs = 0
-                    for msg in threads:
-                        msgs.append(gmail_service.read_message(msg).__str__())
-                        num_msgs += 1
-                        if num_msgs >= 3:
-                            break
+                    msgs = [
+                        str(mail)
+                        for mail in gmail_service.read_messages(islice(threads, 3))
+                    ]
 
                     potential_response = generate_response_email_from_messages(
                         "\n".join(msgs), NAME
@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import date
 
 
 def get_previous_day(date_string: str) -> str:
@@ -7,6 +7,6 @@ def get_previous_day(date_string: str) -> str:
 
     :param date_string: Date string in the format yyyy/mm/dd
     """
-    date = datetime.strptime(date_string, "%Y/%m/%d")
-    previous_day = date - timedelta(days=1)
-    return previous_day.strftime("%Y/%m/%d")
+    year, month, day = map(int, date_string.split("/"))
+    previous_day = date.fromordinal(date(year, month, day).toordinal() - 1)
+    return f"{previous_day.year:04d}/{previous_day.month:02d}/{previous_day.day:02d}"